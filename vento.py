@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import paho.mqtt.client as mqttClient
-import re
 import time
 import socket
+import selectors
 import signal
 import sys
 import logging
 import argparse
-import json
 
 
 '''
@@ -30,6 +29,8 @@ parser.add_argument("--mqtt-port", type=int, default=1883, help="MQTT server por
 parser.add_argument("--mqtt-user", help="MQTT server username")
 parser.add_argument("--mqtt-pass", help="MQTT server password")
 parser.add_argument("--mqtt-topic", default="blauberg-vento", help="MQTT topic")
+parser.add_argument("--control-host", default="127.0.0.1", help="Address of the direct control socket")
+parser.add_argument("--control-port", type=int, help="TCP port of the direct control socket, disabled by default")
 parser.add_argument("--log", default=None, help="Log file path")
 parser.add_argument("--debug", nargs='?', const=10, default=20, help="With debug output")
 args = parser.parse_args()
@@ -42,62 +43,77 @@ logging.basicConfig(
 )
 
 
-class Ventilator:
-    def parsebytes(self, bytestring, params):
-        i = iter(bytestring)
-        for param in i:
-            value = [next(i) for _ in range(params[param][0])]
-            yield (param, value)
+# Response parameters: number -> (value width in bytes, name)
+FAN_PARAMS = {
+    0x03: (1, 'state'),
+    0x04: (1, 'speed'),
+    0x05: (1, 'manual_speed'),
+    0x06: (1, 'air_flow_direction'),
+    0x08: (1, 'humidity_level'),
+    0x09: (1, 'operation_mode'),
+    0x0B: (1, 'humidity_sensor_threshold'),
+    0x0C: (1, 'alarm_status'),
+    0x0D: (1, 'relay_sensor_status'),
+    0x0E: (3, 'party_or_night_mode_countdown'),
+    0x0F: (3, 'night_mode_timer'),
+    0x10: (3, 'party_mode_timer'),
+    0x11: (3, 'deactivation_timer'),
+    0x12: (1, 'filter_eol_timer'),
+    0x13: (1, 'humidity_sensor_status'),
+    0x14: (1, 'boost_mode'),
+    0x15: (1, 'humidity_sensor'),
+    0x16: (1, 'relay_sensor'),
+    0x17: (1, '10V_sensor'),
+    0x19: (1, '10V_sensor_threshold'),
+    0x1A: (1, '10V_sensor_status'),
+    0x1B: (32, 'slave_device_search'),
+    0x1C: (4, 'response_slave_search'),
+    0x1F: (1, 'cloud_activation'),
+    0x25: (1, '10V_sensor_current_status')
+}
+
+# Value width indexed by parameter number, None for unknown parameters
+PARAM_WIDTH = tuple(FAN_PARAMS[i][0] if i in FAN_PARAMS else None for i in range(256))
+
+# UDP command frames
+HEADER = bytes.fromhex('6D6F62696C65')
+FOOTER = bytes.fromhex('0D0A')
+STATUS_REQUEST = HEADER + bytes.fromhex('0100') + FOOTER  # Data request for the control page
+STATE_TOGGLE = HEADER + bytes.fromhex('0300') + FOOTER
+SPEED_FRAMES = tuple(HEADER + bytes((0x04, speed)) + FOOTER for speed in range(4))
+AIRFLOW_FRAMES = tuple(HEADER + bytes((0x06, airflow)) + FOOTER for airflow in range(3))
+
+# Status JSON as published via MQTT, values are sent as strings
+PAYLOAD_FORMAT = '{"state": "%d", "humidity": "%d", "speed": "%d", "airflow": "%d", "man_speed": "%d"}'
 
-    def parse_response(self, data):
-        fan_params = {
-            0x03: [1, 'state', None],
-            0x04: [1, 'speed', None],
-            0x05: [1, 'manual_speed', None],
-            0x06: [1, 'air_flow_direction', None],
-            0x08: [1, 'humidity_level', None],
-            0x09: [1, 'operation_mode', None],
-            0x0B: [1, 'humidity_sensor_threshold', None],
-            0x0C: [1, 'alarm_status', None],
-            0x0D: [1, 'relay_sensor_status', None],
-            0x0E: [3, 'party_or_night_mode_countdown', None],
-            0x0F: [3, 'night_mode_timer', None],
-            0x10: [3, 'party_mode_timer', None],
-            0x11: [3, 'deactivation_timer', None],
-            0x12: [1, 'filter_eol_timer', None],
-            0x13: [1, 'humidity_sensor_status', None],
-            0x14: [1, 'boost_mode', None],
-            0x15: [1, 'humidity_sensor', None],
-            0x16: [1, 'relay_sensor', None],
-            0x17: [1, '10V_sensor', None],
-            0x19: [1, '10V_sensor_threshold', None],
-            0x1A: [1, '10V_sensor_status', None],
-            0x1B: [32, 'slave_device_search', None],
-            0x1C: [4, 'response_slave_search', None],
-            0x1F: [1, 'cloud_activation', None],
-            0x25: [1, '10V_sensor_current_status', None]
-        }
 
-        for pair in self.parsebytes(data, fan_params):
-            if pair[0] == 3:
-                self.state = pair[1][0]
-            elif pair[0] == 4:
-                self.speed = pair[1][0]
-            elif pair[0] == 5:
-                self.man_speed = pair[1][0]
-            elif pair[0] == 6:
-                self.airflow = pair[1][0]
-            elif pair[0] == 8:
-                self.humidity = pair[1][0]
+class Ventilator:
+    def parse_response(self, data):
+        data = memoryview(data)
+        size = len(data)
+        i = 0
+        while i < size:
+            param = data[i]
+            width = PARAM_WIDTH[param]
+            if width is None or i + width >= size:
+                logger.debug("Stop parsing at unknown or truncated parameter 0x%02X", param)
+                break
+            value = data[i + 1]
+            if param == 0x03:
+                self.state = value
+            elif param == 0x04:
+                self.speed = value
+            elif param == 0x05:
+                self.man_speed = value
+            elif param == 0x06:
+                self.airflow = value
+            elif param == 0x08:
+                self.humidity = value
+            i += 1 + width
 
     def payload(self):
-        return json.dumps({
-            'state':     str(self.state),
-            'humidity':  str(self.humidity),
-            'speed':     str(self.speed),
-            'airflow':   str(self.airflow),
-            'man_speed': str(self.man_speed)
-        })
+        # Every value is a single byte, so the JSON document can be formatted directly
+        return PAYLOAD_FORMAT % (self.state, self.humidity, self.speed, self.airflow, self.man_speed)
 
 
 class Vento:
@@ -108,10 +124,28 @@ class Vento:
         self.mqtt_user = args.mqtt_user
         self.mqtt_password = args.mqtt_pass
         self.mqtt_topic = args.mqtt_topic
+        self.topic_status = self.mqtt_topic + "/status"
+        self.topic_service = self.mqtt_topic + "/service"
+        self.topic_state = self.mqtt_topic + "/command/state"
+        self.topic_speed = self.mqtt_topic + "/command/speed"
+        self.topic_airflow = self.mqtt_topic + "/command/airflow"
+        # Command topic -> (requested value attribute, change flag attribute, valid values)
+        self.commands = {
+            self.topic_state: ("ventilator_state", "change_onoff", ("0", "1")),
+            self.topic_speed: ("ventilator_speed", "change_speed", ("0", "1", "2", "3")),
+            self.topic_airflow: ("ventilator_airflow", "change_airflow", ("0", "1", "2"))
+        }
 
         self.connected = False
         self.ventilator = Ventilator()
         self.sleeptime = 5  # Socket sleep time
+        self.timeout = 10  # Seconds to wait for a status response
+        self.online_interval = 30  # Seconds between "Online" heartbeats
+        self.service_state = None
+        self.service_published = 0
+        self.udp_socket = None
+        self.response_buffer = memoryview(bytearray(98))  # Reused for every response
+        self.last_response = None
         self.ventilator_state = False
         self.ventilator_speed = False
         self.ventilator_airflow = False
@@ -119,6 +153,18 @@ class Vento:
         self.change_speed = False
         self.change_airflow = False
 
+        self.control_host = args.control_host
+        self.control_port = args.control_port
+        self.control_server = None
+        self.control_conn = None
+        self.control_buffer = b""
+        # Direct control frames: <command><value>\n, e.g. b"f3\n" sets speed 3
+        self.control_topics = {
+            b"s": self.topic_state,
+            b"f": self.topic_speed,
+            b"a": self.topic_airflow
+        }
+
         self.client = mqttClient.Client(mqttClient.CallbackAPIVersion.VERSION2)
         self.client.username_pw_set(self.mqtt_user, password=self.mqtt_password)
         self.client.on_connect = self.on_connect
@@ -126,16 +172,21 @@ class Vento:
         self.client.on_subscribe = self.on_subscribe
         self.client.on_unsubscribe = self.on_unsubscribe
         self.client.on_disconnect = self.on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
 
     def start(self):
         try:
             signal.signal(signal.SIGTERM, self.exit_gracefully)
             self.connect_to_mqtt()
+            if self.control_port:
+                self.open_control_server()
             while True:
                 self.main_loop()
         except (KeyboardInterrupt, SystemExit):
-            self.client.publish(self.mqtt_topic + "/service", "Service Down")
+            self.publish_service("Service Down")
             logger.info("Start cleanup")
+            if self.control_server is not None:
+                self.control_server.close()
             self.client.loop_stop()
             time.sleep(2)
             self.client.disconnect()
@@ -143,25 +194,30 @@ class Vento:
             sys.exit(0)
 
     def connect_to_mqtt(self):
-        try:
-            self.client.connect(self.broker_address, port=self.mqtt_port)
-            self.client.loop_start()
-        except socket.error as error:
-            logger.error("MQTT connection: %s" % error)
-            time.sleep(2)
-            self.connect_to_mqtt()
+        backoff = 2
+        while True:
+            try:
+                self.client.connect(self.broker_address, port=self.mqtt_port)
+                self.client.loop_start()
+                return
+            except socket.error as error:
+                logger.error("MQTT connection: %s, retrying in %s s", error, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
 
     def subscribe_to_topics(self):
         self.client.subscribe([
-            (self.mqtt_topic + "/command/state", 0),
-            (self.mqtt_topic + "/command/speed", 0),
-            (self.mqtt_topic + "/command/airflow", 0)
+            (self.topic_state, 0),
+            (self.topic_speed, 0),
+            (self.topic_airflow, 0)
         ])
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
             logger.info("Connected to a MQTT broker")
             self.connected = True
+            self.service_state = None  # Announce the service state again on the next poll
+            self.set_mqtt_socket_options(client.socket())
             self.subscribe_to_topics()
         elif reason_code == 1:
             logger.error("Wrong protocol version")
@@ -174,122 +230,248 @@ class Vento:
         elif reason_code == 5:
             logger.error("Unauthorized")
         else:
-            logger.error("Failed with unknown error code: " + str(reason_code))
+            logger.error("Failed with unknown error code: %s", reason_code)
+
+    def set_mqtt_socket_options(self, sock):
+        # Small status and command packets should not wait for Nagle coalescing
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        except (AttributeError, socket.error) as error:
+            logger.warning("MQTT socket options not set: %s", error)
 
     def on_disconnect(self, client, userdata, flags, reason_code, properties):
         if reason_code != 0:
+            # The loop_start() thread reconnects with the reconnect_delay_set() backoff
             logger.info("A disconnect was received, try reconnecting...")
-            client.reconnect()
 
     def on_message(self, client, userdata, message):
-        logger.debug("Messagetopic=" + message.topic + " Message=" + str(message.payload))
-        data = str(message.payload)
-        data = data[2:len(data)-1]
-        logger.debug("Message="+data)
-
-        if str(message.topic) == self.mqtt_topic + "/command/state" and re.match(r"[0-1]", data):
-            self.ventilator_state = data
-            self.change_onoff = True
-
-        if str(message.topic) == self.mqtt_topic + "/command/speed" and re.match(r"[0-3]", data):
-            self.ventilator_speed = data
-            self.change_speed = True
-
-        if str(message.topic) == self.mqtt_topic + "/command/airflow" and re.match(r"[0-2]", data):
-            self.ventilator_airflow = data
-            self.change_airflow = True
+        logger.debug("Messagetopic=%s Message=%s", message.topic, message.payload)
+        data = message.payload.decode("utf-8", "replace").strip()
+        logger.debug("Message=%s", data)
+        self.handle_command(message.topic, data)
+
+    def handle_command(self, topic, data):
+        command = self.commands.get(topic)
+        if command is None or data not in command[2]:
+            logger.error("Invalid command %s for %s", data, topic)
+            return
+        setattr(self, command[0], int(data))
+        setattr(self, command[1], True)
+
+    def open_control_server(self):
+        self.control_server = socket.create_server((self.control_host, self.control_port))
+        self.control_server.setblocking(False)
+        logger.info("Listening for control connections on %s:%s", self.control_host, self.control_port)
+
+    def accept_control(self, selector, server):
+        try:
+            conn, address = server.accept()
+        except socket.error as error:
+            logger.error("Control connection: %s", error)
+            return
+        logger.info("Control connection from %s:%s", *address[:2])
+        # Only one controller at a time, the newest one wins
+        self.close_control(selector)
+        conn.setblocking(False)
+        selector.register(conn, selectors.EVENT_READ, self.read_control)
+        self.control_conn = conn
+
+    def read_control(self, selector, conn):
+        if conn is not self.control_conn:
+            return  # Replaced by a newer connection in the same select() round
+        try:
+            data = conn.recv(64)
+        except socket.error as error:
+            logger.error("Control connection: %s", error)
+            data = b""
+        if not data:
+            logger.info("Control connection closed")
+            self.close_control(selector)
+            return
+        frames = (self.control_buffer + data).split(b"\n")
+        self.control_buffer = frames.pop()
+        if len(self.control_buffer) > 2:
+            logger.error("Invalid control frame: %s", self.control_buffer)
+            self.close_control(selector)
+            return
+        for frame in frames:
+            topic = self.control_topics.get(frame[:1])
+            if topic is None or len(frame) != 2:
+                logger.error("Invalid control frame: %s", frame)
+                continue
+            logger.debug("Control frame=%s", frame)
+            self.handle_command(topic, frame[1:].decode("ascii", "replace"))
+
+    def close_control(self, selector):
+        if self.control_conn is not None:
+            selector.unregister(self.control_conn)
+            self.control_conn.close()
+            self.control_conn = None
+        self.control_buffer = b""
 
     def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
-        logger.debug("On subscribe: " + str(mid))
+        logger.debug("On subscribe: %s", mid)
 
     def on_unsubscribe(self, client, userdata, mid, reason_code_list, properties):
-        logger.debug("On unsubscribe: " + str(mid))
+        logger.debug("On unsubscribe: %s", mid)
+
+    def publish(self, topic, payload):
+        rc = self.client.publish(topic, payload, qos=0, retain=False).rc
+        if rc != mqttClient.MQTT_ERR_SUCCESS:
+            logger.error("MQTT publish to %s failed: %s", topic, mqttClient.error_string(rc))
+        return rc
 
     def send_mqtt(self, msg):
-        self.client.publish(self.mqtt_topic + "/status", msg)
-        self.client.publish(self.mqtt_topic + "/service", "Online")
+        self.publish(self.topic_status, msg)
 
-    def main_loop(self):
-        retry = 1
-        alt_status = ""
+    def publish_service(self, state):
+        if self.publish(self.topic_service, state) != mqttClient.MQTT_ERR_SUCCESS:
+            return
+        self.service_state = state
+        self.service_published = time.monotonic()
 
-        HEADER = bytes.fromhex('6D6F62696C65')
-        FOOTER = bytes.fromhex('0D0A')
+    def publish_online(self):
+        # Repeat "Online" only as a periodic heartbeat or to replace another service state
+        if self.service_state != "Online" or time.monotonic() - self.service_published > self.online_interval:
+            self.publish_service("Online")
 
-        # Data request for the control page
-        data = bytes.fromhex('6D6F62696C6501000D0A')
+    def open_udp_socket(self):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Room for a burst of responses if the loop is delayed
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+        udp_socket.setblocking(False)
+        return udp_socket
+
+    def report_timeout(self, error, retry):
+        logger.error("Socket Error: %s", error)
+        self.publish_service("TimeOut")
+        logger.info("Waiting for a response from the ventilation system #%s", retry)
+
+    def main_loop(self):
+        retry = 1
+        alt_status = None
 
         # UDP Socket
-        addr = (self.ventilator_host, 4000)
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.settimeout(10)
+        if self.udp_socket is None:
+            self.udp_socket = self.open_udp_socket()
+        udp_socket = self.udp_socket
+        selector = selectors.DefaultSelector()
+        selector.register(udp_socket, selectors.EVENT_READ)
+        if self.control_server is not None:
+            selector.register(self.control_server, selectors.EVENT_READ, self.accept_control)
+        if self.control_conn is not None:
+            # The controller connection outlives a restart of the UDP leg
+            selector.register(self.control_conn, selectors.EVENT_READ, self.read_control)
+        deadline = 0  # Time of the next status request or of the response timeout
+        waiting = False
+        connected = False
         while True:
             try:
-                udp_socket.sendto(data, addr)
-                response = udp_socket.recv(98)
-                logger.debug("Raw response: " + str(response))
-                self.ventilator.parse_response(response[6:])
-                status = str(self.ventilator.state) + "-" + str(self.ventilator.speed) + "-" + str(self.ventilator.man_speed) + "-" + str(self.ventilator.humidity) + "-" + str(self.ventilator.airflow)
+                now = time.monotonic()
+                if now >= deadline:
+                    if waiting:
+                        self.report_timeout("timed out", retry)
+                        retry += 1
+                        waiting = False
+                        connected = False  # The unit may have a new address by now
+                        deadline = now + self.sleeptime
+                        continue
+                    if not connected:
+                        # Resolve the unit once, the kernel then drops datagrams from other senders
+                        udp_socket.connect((self.ventilator_host, 4000))
+                        connected = True
+                    udp_socket.send(STATUS_REQUEST)
+                    waiting = True
+                    deadline = now + self.timeout
+                received = False
+                for key, mask in selector.select(deadline - now):
+                    if key.fileobj is udp_socket:
+                        received = True
+                    else:
+                        key.data(selector, key.fileobj)
+                        if not waiting:
+                            deadline = now  # Request the status right away to apply a command
+                if not received:
+                    continue
+                response = self.response_buffer[:udp_socket.recv_into(self.response_buffer)]
+                reply = waiting
+                waiting = False
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Raw response: %s", response.tobytes())
+                # An unchanged datagram cannot change the parsed status
+                if response != self.last_response:
+                    self.last_response = response.tobytes()
+                    self.ventilator.parse_response(response[6:])
+                ventilator = self.ventilator
+                state, speed, airflow = ventilator.state, ventilator.speed, ventilator.airflow
+                status = (state, speed, ventilator.man_speed, ventilator.humidity, airflow)
                 if self.ventilator_state is False:
-                    self.ventilator_state = self.ventilator.state
+                    self.ventilator_state = state
                 if self.ventilator_speed is False:
-                    self.ventilator_speed = self.ventilator.speed
+                    self.ventilator_speed = speed
                 if self.ventilator_airflow is False:
-                    self.ventilator_airflow = self.ventilator.airflow
-
-                if int(self.ventilator_state) != int(self.ventilator.state):
-                    if self.change_onoff is True:
-                        logger.info("Change status: " + str(self.ventilator_state))
-                        udp_socket.sendto(bytes.fromhex('6D6F62696C6503000D0A'), addr)
+                    self.ventilator_airflow = airflow
+
+                # Pending commands are sent only once per status request; other datagrams,
+                # like the replies to those commands, just update the published status
+                if reply:
+                    if self.ventilator_state != state:
+                        if self.change_onoff is True:
+                            logger.info("Change status: %s", self.ventilator_state)
+                            udp_socket.send(STATE_TOGGLE)
+                        else:
+                            self.ventilator_state = state
                     else:
-                        self.ventilator_state = self.ventilator.state
-                else:
-                    self.change_onoff = False
-                if int(self.ventilator_speed) != int(self.ventilator.speed):
-                    if self.change_speed is True:
-                        logger.info("Change speed: " + str(self.ventilator_speed))
-                        cmd = '04' + '{0:0{1}x}'.format(int(self.ventilator_speed), 2)
-                        udp_socket.sendto((HEADER + bytes.fromhex(cmd) + FOOTER), addr)
+                        self.change_onoff = False
+                    if self.ventilator_speed != speed:
+                        if self.change_speed is True:
+                            logger.info("Change speed: %s", self.ventilator_speed)
+                            udp_socket.send(SPEED_FRAMES[self.ventilator_speed])
+                        else:
+                            self.ventilator_speed = speed
                     else:
-                        self.ventilator_speed = self.ventilator.speed
-                else:
-                    self.change_speed = False
-                if int(self.ventilator_airflow) != int(self.ventilator.airflow):
-                    if self.change_airflow is True:
-                        logger.info("Change airflow: " + str(self.ventilator_airflow))
-                        cmd = '06' + '{0:0{1}x}'.format(int(self.ventilator_airflow), 2)
-                        udp_socket.sendto((HEADER + bytes.fromhex(cmd) + FOOTER), addr)
+                        self.change_speed = False
+                    if self.ventilator_airflow != airflow:
+                        if self.change_airflow is True:
+                            logger.info("Change airflow: %s", self.ventilator_airflow)
+                            udp_socket.send(AIRFLOW_FRAMES[self.ventilator_airflow])
+                        else:
+                            self.ventilator_airflow = airflow
                     else:
-                        self.ventilator_airflow = self.ventilator.airflow
-                else:
-                    self.change_airflow = False
-                logger.debug(self.ventilator.payload())
+                        self.change_airflow = False
                 if alt_status != status:
-                    self.send_mqtt(self.ventilator.payload())
+                    payload = ventilator.payload()
+                    logger.debug(payload)
+                    self.send_mqtt(payload)
                 alt_status = status
-                self.client.publish(self.mqtt_topic + "/service", "Online")
-                retry = 1
-                signal.signal(signal.SIGTERM, self.exit_gracefully)
-                time.sleep(self.sleeptime)
-            except socket.timeout as error:
-                logger.error("Socket Error: %s" % error)
-                self.client.publish(self.mqtt_topic + "/service", "TimeOut")
-                time.sleep(self.sleeptime)
-                logger.info("Waiting for a response from the ventilation system #" + str(retry))
+                self.publish_online()
+                if reply:
+                    retry = 1
+                    deadline = time.monotonic() + self.sleeptime
+            except ConnectionRefusedError as error:
+                # The connected socket reports the unit's ICMP refusal instead of timing out
+                self.report_timeout(error, retry)
                 retry += 1
-                pass
+                waiting = False
+                connected = False
+                deadline = time.monotonic() + self.sleeptime
             except socket.error as error:
-                logger.error("Unhandled Socket Error: %s" % error)
+                logger.error("Unhandled Socket Error: %s", error)
+                selector.close()
                 udp_socket.close()
+                self.udp_socket = None
                 time.sleep(5)
-                pass
+                return
             except (KeyboardInterrupt, SystemExit):
                 logger.info("Exiting")
+                self.close_control(selector)
+                selector.close()
                 udp_socket.close()
                 sys.exit(0)
 
     def exit_gracefully(self, signum, frame):
-        self.client.publish(self.mqtt_topic + "/service", "Service Down")
+        self.publish_service("Service Down")
         logger.info("Terminate service due to TERM signal")
         self.client.disconnect()
         time.sleep(1)